@@ -1,18 +1,39 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from langchain_core.messages import HumanMessage
+from langchain_core.messages import AIMessageChunk, HumanMessage
 from typing import Optional, Dict, Any
+from pathlib import Path
 import os
-import json
+import logging
+import orjson
+import time
 
-from main import chain, vectorstore
+from main import chain, vectorstore, ollama_transport
+from cache import cache
+
+logger = logging.getLogger(__name__)
 
 # Create static directory if it doesn't exist
 os.makedirs("static", exist_ok=True)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Load the chat interface and warm up the vector store before the worker starts accepting requests."""
+    app.state.index_html = Path("static/index.html").read_text(encoding="utf-8")
+    
+    try:
+        # Loads the HNSW index from disk and the model into Ollama
+        await vectorstore.asimilarity_search("warmup", k=1)
+    except Exception as e:
+        logger.warning("Vector store warmup failed: %s", e)
+    yield
+    await ollama_transport.aclose()
+
 app = FastAPI(
+    lifespan=lifespan,
     title="AI Knowledge Assistant",
     description="""
     An intelligent multi-agent system for processing and querying your personal knowledge base.
@@ -20,6 +41,7 @@ app = FastAPI(
     Available endpoints:
     - GET /: Interactive chat interface
     - POST /query: Query your knowledge base
+    - GET /query/stream: Stream agent outputs for a query as Server-Sent Events
     - GET /status: Check system status
     """,
     version="1.0.0"
@@ -38,34 +60,44 @@ class Query(BaseModel):
             }
         }
 
+class QueryResponse(BaseModel):
+    response: str
+
 @app.get("/", response_class=HTMLResponse)
 async def root():
     """Serve the chat interface."""
-    with open("static/index.html", "r") as f:
-        return f.read()
+    return HTMLResponse(app.state.index_html)
 
-@app.post("/query")
+@app.post("/query", response_model=QueryResponse)
 async def query_knowledge_base(query: Query):
     """Query your knowledge base."""
     try:
+        # Serve repeated or near-identical questions from the cache
+        cached = await cache.get(query.query)
+        if cached:
+            return cached
+        
         # Create message
         message = HumanMessage(content=query.query)
         
         # Run the chain
-        result = chain.invoke({
-            "messages": [message]
+        result = await chain.ainvoke({
+            "messages": [message],
+            "query_embedding": await cache.embed(query.query)
         })
         
         # Get the agent outputs
         agent_outputs = result.get("agent_outputs", {})
         
         # Return formatted response
-        return {
-            "response": "\n".join([
+        response = {
+            "response": "\n".join(
                 output for output in agent_outputs.values()
                 if output is not None
-            ])
+            )
         }
+        await cache.set(query.query, response)
+        return response
         
     except Exception as e:
         raise HTTPException(
@@ -73,16 +105,81 @@ async def query_knowledge_base(query: Query):
             detail=f"Error processing query: {str(e)}"
         )
 
+def format_sse(event: str, data: Dict[str, Any]) -> str:
+    """Format a Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n"
+
+@app.get("/query/stream")
+async def stream_knowledge_base(query: str):
+    """Stream LLM tokens and agent outputs for a query as Server-Sent Events."""
+    async def event_generator():
+        try:
+            cached = await cache.get(query)
+            if cached:
+                yield format_sse("done", cached)
+                return
+            
+            agent_outputs = {}
+            async for mode, payload in chain.astream(
+                {
+                    "messages": [HumanMessage(content=query)],
+                    "query_embedding": await cache.embed(query)
+                },
+                stream_mode=["messages", "updates"]
+            ):
+                if mode == "messages":
+                    # Token chunk from an LLM call inside a node. Messages that
+                    # nodes return in their state (the user's query) are skipped.
+                    chunk, metadata = payload
+                    if isinstance(chunk, AIMessageChunk) and chunk.content:
+                        yield format_sse("token", {
+                            "node": metadata.get("langgraph_node"),
+                            "run": chunk.id,
+                            "text": chunk.content
+                        })
+                    continue
+                
+                # A node finished, send the sections it added
+                for node, update in payload.items():
+                    for name, output in update.get("agent_outputs", {}).items():
+                        if output is not None and name not in agent_outputs:
+                            agent_outputs[name] = output
+                            yield format_sse("section", {"node": node, "content": output})
+            
+            response = {"response": "\n".join(agent_outputs.values())}
+            await cache.set(query, response)
+            yield format_sse("done", response)
+            
+        except Exception as e:
+            yield format_sse("query_error", {"detail": f"Error processing query: {str(e)}"})
+    
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Last /status result, reused for STATUS_TTL seconds so frequent probes
+# don't hit the Chroma database on every call
+STATUS_TTL = 1.0
+_status_cache = {"time": 0.0, "value": None}
+
 @app.get("/status")
 async def get_status():
     """Get the current status of your knowledge base."""
+    now = time.monotonic()
+    if _status_cache["value"] is not None and now - _status_cache["time"] < STATUS_TTL:
+        return _status_cache["value"]
+    
     try:
         collection = vectorstore._collection
-        return {
+        status = {
             "status": "ready",
             "documents_count": collection.count(),
             "collection_name": collection.name
         }
+        _status_cache.update(time=now, value=status)
+        return status
     except Exception as e:
         return {
             "status": "error",
@@ -91,4 +188,4 @@ async def get_status():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run("api:app", host="0.0.0.0", port=8000, workers=int(os.getenv("WEB_CONCURRENCY", "1")))
@@ -0,0 +1,182 @@
+from typing import Any, Dict, List, Optional, Tuple
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+from main import embeddings
+
+logger = logging.getLogger(__name__)
+
+try:
+    import redis.asyncio as redis
+except ImportError:
+    redis = None
+
+REDIS_URL = os.getenv("REDIS_URL")
+CACHE_TTL = int(os.getenv("CACHE_TTL", "3600"))
+SIMILARITY_THRESHOLD = float(os.getenv("CACHE_SIMILARITY_THRESHOLD", "0.92"))
+
+class MemoryBackend:
+    """In-process LRU backend for the response cache."""
+
+    def __init__(self, max_size: int = 256):
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: Dict[str, Any], ttl: int) -> None:
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+class RedisBackend:
+    """Redis backend for sharing the response cache between processes."""
+
+    def __init__(self, url: str):
+        if redis is None:
+            raise ImportError("The redis package is required for RedisBackend")
+        self._client = redis.from_url(url)
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        value = await self._client.get(f"llm_cache:{key}")
+        return json.loads(value) if value is not None else None
+
+    async def set(self, key: str, value: Dict[str, Any], ttl: int) -> None:
+        await self._client.set(f"llm_cache:{key}", json.dumps(value), ex=ttl)
+
+class SemanticIndex:
+    """In-process index of recent query embeddings for similarity lookups.
+
+    Kept in memory rather than in Chroma so that each worker process owns its
+    index and never writes to the shared persist directory.
+    """
+
+    def __init__(self, max_size: int = 256):
+        self.max_size = max_size
+        self._vectors: "OrderedDict[str, np.ndarray]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._vectors)
+
+    def search(self, vector: np.ndarray) -> Optional[Tuple[str, float]]:
+        """Return the key and cosine similarity of the closest stored query."""
+        if not self._vectors:
+            return None
+
+        keys = list(self._vectors)
+        similarities = np.stack(list(self._vectors.values())) @ vector
+        best = int(np.argmax(similarities))
+        return keys[best], float(similarities[best])
+
+    def add(self, key: str, vector: np.ndarray) -> None:
+        self._vectors[key] = vector
+        self._vectors.move_to_end(key)
+        while len(self._vectors) > self.max_size:
+            self._vectors.popitem(last=False)
+
+    def remove(self, key: str) -> None:
+        self._vectors.pop(key, None)
+
+class LLMCache:
+    """Exact and semantic cache for knowledge base responses.
+
+    Responses are stored in the backend under the SHA-256 of the query. On an
+    exact miss, the query is compared against recently answered queries in an
+    in-process SemanticIndex and the closest match is reused when its cosine
+    similarity clears the threshold.
+    """
+
+    def __init__(self, backend, ttl: int = 3600, similarity_threshold: float = 0.92):
+        self.backend = backend
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.semantic_index = SemanticIndex()
+        # Embeddings of queries that missed the cache, shared by the semantic
+        # lookup, the retriever and set() so each query is embedded only once
+        self._query_embeddings: "OrderedDict[str, List[float]]" = OrderedDict()
+
+    @staticmethod
+    def key(query: str) -> str:
+        return hashlib.sha256(json.dumps({"q": query}, sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def _normalize(vector: List[float]) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    async def embed(self, query: str) -> List[float]:
+        """Return the query's embedding, reusing it until set() stores the response."""
+        key = self.key(query)
+        vector = self._query_embeddings.get(key)
+        if vector is None:
+            vector = await embeddings.aembed_query(query)
+            self._query_embeddings[key] = vector
+            while len(self._query_embeddings) > self.semantic_index.max_size:
+                self._query_embeddings.popitem(last=False)
+        return vector
+
+    async def get(self, query: str) -> Optional[Dict[str, Any]]:
+        """Return a cached response for the query, if any. Cache errors count as a miss."""
+        try:
+            return await self._lookup(query)
+        except Exception as e:
+            logger.warning("Response cache lookup failed: %s", e)
+            return None
+
+    async def _lookup(self, query: str) -> Optional[Dict[str, Any]]:
+        cached = await self.backend.get(self.key(query))
+        if cached is not None:
+            return cached
+
+        # Fall back to the closest previously answered query
+        if not self.semantic_index:
+            return None
+        hit = self.semantic_index.search(self._normalize(await self.embed(query)))
+        if hit is None:
+            return None
+
+        key, similarity = hit
+        if similarity < self.similarity_threshold:
+            return None
+
+        cached = await self.backend.get(key)
+        if cached is None:
+            # The backend entry expired or was evicted, drop the stale pointer
+            self.semantic_index.remove(key)
+        return cached
+
+    async def set(self, query: str, response: Dict[str, Any]) -> None:
+        """Store a response for the query in both cache layers. Cache errors are only logged."""
+        key = self.key(query)
+        try:
+            await self.backend.set(key, response, self.ttl)
+            vector = self._query_embeddings.pop(key, None)
+            if vector is None:
+                vector = await embeddings.aembed_query(query)
+            self.semantic_index.add(key, self._normalize(vector))
+        except Exception as e:
+            logger.warning("Response cache store failed: %s", e)
+
+cache = LLMCache(
+    RedisBackend(REDIS_URL) if REDIS_URL else MemoryBackend(),
+    ttl=CACHE_TTL,
+    similarity_threshold=SIMILARITY_THRESHOLD
+)
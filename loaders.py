@@ -0,0 +1,22 @@
+from typing import List
+from langchain_community.document_loaders import (
+    PyPDFLoader,
+    TextLoader,
+    UnstructuredMarkdownLoader
+)
+
+# Loader for each supported file extension
+SUPPORTED_EXTENSIONS = {
+    '.pdf': PyPDFLoader,
+    '.txt': TextLoader,
+    '.md': UnstructuredMarkdownLoader
+}
+
+def load_document(file_path: str, ext: str) -> List[tuple]:
+    """Parse a document in a worker process, returning (page_content, metadata) tuples.
+
+    Kept apart from processor.py so parse workers don't import main and build
+    their own Chroma and Ollama clients.
+    """
+    loader = SUPPORTED_EXTENSIONS[ext](file_path)
+    return [(doc.page_content, doc.metadata) for doc in loader.load()]
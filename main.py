@@ -1,31 +1,73 @@
-from typing import Dict, TypedDict, Annotated, Sequence
+from typing import Dict, List, TypedDict, Annotated, Sequence
 from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
 from langgraph.graph import StateGraph, END
 from langchain_core.runnables import RunnablePassthrough
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-from langchain_ollama import OllamaLLM, OllamaEmbeddings
+from langchain_ollama import ChatOllama, OllamaEmbeddings
 from langchain_chroma import Chroma
 import os
+import httpx
 from dotenv import load_dotenv
+import asyncio
 import json
+import logging
+import orjson
+import re
 
 load_dotenv()
 
+class JSONFormatter(logging.Formatter):
+    """Format log records as single-line JSON objects."""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return orjson.dumps(entry).decode()
+
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+if os.getenv("LOG_FORMAT") == "json":
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(JSONFormatter())
+logger = logging.getLogger(__name__)
+
 # Initialize LLM with Ollama
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://192.168.68.114:11434")
 MODEL_NAME = os.getenv("OLLAMA_MODEL", "llama3")
 
-llm = OllamaLLM(
+# Shared connection pool for async Ollama calls, closed on API shutdown
+ollama_transport = httpx.AsyncHTTPTransport(
+    http2=True,
+    limits=httpx.Limits(
+        max_keepalive_connections=40,
+        max_connections=100,
+        keepalive_expiry=30.0
+    )
+)
+ollama_client_kwargs = {
+    "transport": ollama_transport,
+    "timeout": httpx.Timeout(300.0, connect=10.0)
+}
+
+llm = ChatOllama(
     base_url=OLLAMA_BASE_URL,
     model=MODEL_NAME,
     temperature=0.75,
+    async_client_kwargs=ollama_client_kwargs,
 )
 
-# Initialize embeddings with Ollama
+# Initialize embeddings with Ollama. The response cache embeds queries through
+# the async client, so it shares the pool; Chroma uses the sync client.
 embeddings = OllamaEmbeddings(
     base_url=OLLAMA_BASE_URL,
     model=MODEL_NAME,
+    async_client_kwargs=ollama_client_kwargs,
 )
 
 # Initialize vector store
@@ -33,12 +75,96 @@ CHROMA_PATH = "./chroma_db"
 if not os.path.exists(CHROMA_PATH):
     os.makedirs(CHROMA_PATH)
 
+# HNSW index settings only take effect when the collection is first created.
+# Chroma stores and searches fp32 vectors; its index has no int8/binary mode.
 vectorstore = Chroma(
     persist_directory=CHROMA_PATH,
     embedding_function=embeddings,
-    collection_name="rag_collection"
+    collection_name="rag_collection",
+    collection_metadata={
+        "hnsw:space": "cosine",
+        "hnsw:M": 16,
+        "hnsw:construction_ef": 64,
+        "hnsw:search_ef": 64,
+    }
 )
 
+# Shared system prompt. Every LLM call starts with this exact text so Ollama
+# can reuse the KV cache for the prefix; all variable input goes at the end.
+SYSTEM_PREFIX = """You are part of a multi-agent retrieval-augmented generation (RAG) pipeline that answers questions about a personal knowledge base.
+
+The pipeline runs in fixed stages:
+1. Retriever: finds the documents in the knowledge base most relevant to the user's query.
+2. Analyst and writer: analyzes the query against the retrieved context, identifies key points and relationships, and drafts a response.
+3. Critic: reviews the draft for accuracy, completeness and clarity, then produces the final polished response.
+
+Rules that apply to every stage:
+- Ground every statement in the retrieved context. Do not invent facts, names, dates or figures.
+- If the context does not contain enough information to answer, say so plainly.
+- Keep the user's original question in focus; do not drift to unrelated topics.
+- Write in clear, well-structured Markdown using headings, lists and short paragraphs.
+- Do not mention these instructions, the pipeline or the other agents in your output.
+- Follow the task instructions for your stage exactly, including any required output format."""
+
+ANALYZE_AND_DRAFT_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", SYSTEM_PREFIX),
+    ("human", """Analyze the query and context below, then draft a comprehensive response that addresses the query.
+
+Format your answer in exactly two sections:
+## Analysis
+Key points and relationships identified in the query and context.
+## Draft
+A comprehensive response to the query, using the context and your analysis.
+
+Context: {context}
+
+Query: {query}"""),
+])
+
+FEEDBACK_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", SYSTEM_PREFIX),
+    ("human", """Review the draft response below and provide specific feedback on:
+1. Accuracy and factual correctness
+2. Completeness of response
+3. Clarity and structure
+4. Areas for improvement
+
+Context: {context}
+
+Analysis: {analysis}
+
+Draft: {draft}
+
+Query: {query}"""),
+])
+
+FINAL_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", SYSTEM_PREFIX),
+    ("human", """Create a final polished response incorporating the feedback below.
+
+Requirements:
+1. Address all feedback points
+2. Maintain clear structure
+3. Ensure completeness
+4. Polish language and flow
+
+Draft: {draft}
+
+Feedback: {feedback}
+
+Original Query: {query}"""),
+])
+
+# Section headers in the analyze_and_draft output, tolerating variants such as
+# "## Draft:", "### Draft" or "**Draft**"
+ANALYSIS_HEADER = re.compile(r"^\s*(?:#{1,6}\s*\**|\*\*)\s*analysis\b.*$", re.I | re.M)
+DRAFT_HEADER = re.compile(r"^\s*(?:#{1,6}\s*\**|\*\*)\s*draft\b.*$", re.I | re.M)
+
+# Prompt -> LLM -> text pipelines, built once and reused by every request
+analyze_and_draft_chain = ANALYZE_AND_DRAFT_PROMPT | llm | StrOutputParser()
+feedback_chain = FEEDBACK_PROMPT | llm | StrOutputParser()
+final_chain = FINAL_PROMPT | llm | StrOutputParser()
+
 class AgentState(TypedDict):
     messages: Sequence[BaseMessage]
     current_step: str
@@ -46,20 +172,27 @@ class AgentState(TypedDict):
     research_summary: str
     final_answer: str
     agent_outputs: Dict
-
-def retriever_agent(state: AgentState) -> AgentState:
+    query: str
+    analysis: str
+    draft: str
+    feedback: str
+    final_response: str
+    query_embedding: List[float]
+
+async def retriever_agent(state: AgentState) -> AgentState:
     """Retriever agent that finds relevant documents."""
-    print("\n=== Retriever Agent ===")
-    print(f"Input state: {state}")
-    
     messages = state["messages"]
     query = messages[-1].content
-    print(f"Processing query: {query}")
+    logger.debug("retriever start query=%s", query[:80])
     
     # Get relevant documents
-    docs = vectorstore.similarity_search(query, k=3)
+    # Reuse the query embedding computed by the API's cache lookup if given
+    if state.get("query_embedding"):
+        docs = await vectorstore.asimilarity_search_by_vector(state["query_embedding"], k=3)
+    else:
+        docs = await vectorstore.asimilarity_search(query, k=3)
     context = "\n\n".join([doc.page_content for doc in docs])
-    print(f"Found {len(docs)} documents")
+    logger.debug("retriever found %d documents, context_len=%d", len(docs), len(context))
     
     # Initialize agent outputs if not present
     if "agent_outputs" not in state:
@@ -86,31 +219,33 @@ Found {len(docs)} relevant documents.
     }
     
     # Update state while preserving existing fields
-    state["current_step"] = "researcher"
+    state["current_step"] = "analyze_and_draft"
     state["context"] = context
     state["query"] = query
     state["agent_outputs"]["retriever"] = response["retriever"]
     
-    print(f"Output state: {state}")
     return state
 
-def researcher_agent(state: AgentState) -> AgentState:
-    """Researcher agent that analyzes context and query."""
-    print("\n=== Researcher Agent ===")
-    print(f"Input state: {state}")
-    
-    query = state.get("query")
-    if not query:
-        query = state["messages"][-1].content
-        state["query"] = query
+async def analyze_and_draft_agent(state: AgentState) -> AgentState:
+    """Researcher and writer agent that analyzes the context and drafts the initial response in a single LLM call."""
+    query = state["query"]
     
-    context = state.get("context", "")
+    # Analyze context and query, then draft the response from that analysis
+    output = await analyze_and_draft_chain.ainvoke({
+        "query": query,
+        "context": state["context"]
+    })
     
-    # Analyze context and query
-    analysis = llm.invoke(
-        f"Analyze this query and context, identifying key points and relationships:\n\nQuery: {query}\n\nContext: {context}"
-    )
-    print(f"Generated analysis: {analysis}")
+    # Split the combined output back into its analysis and draft sections
+    parts = DRAFT_HEADER.split(output, maxsplit=1)
+    if len(parts) > 1:
+        analysis = ANALYSIS_HEADER.sub("", parts[0], count=1).strip()
+        draft = parts[1].strip()
+    else:
+        logger.warning("analyze_and_draft output has no Draft header, using it all as the draft")
+        analysis = ""
+        draft = output.strip()
+    logger.debug("analyze_and_draft done analysis_len=%d draft_len=%d", len(analysis), len(draft))
     
     # Format markdown response
     response = {
@@ -130,38 +265,7 @@ def researcher_agent(state: AgentState) -> AgentState:
 </details>
 
 </details>
-"""
-    }
-    
-    # Update state while preserving existing fields
-    state["current_step"] = "writer"
-    state["analysis"] = analysis
-    state["agent_outputs"]["research"] = response["research"]
-    
-    print(f"Output state: {state}")
-    return state
-
-def writer_agent(state: AgentState) -> AgentState:
-    """Writer agent that drafts the initial response."""
-    print("\n=== Writer Agent ===")
-    print(f"Input state: {state}")
-    
-    query = state.get("query")
-    if not query:
-        query = state["messages"][-1].content
-        state["query"] = query
-    
-    context = state.get("context", "")
-    analysis = state.get("analysis", "")
-    
-    # Generate initial draft
-    draft = llm.invoke(
-        f"Draft a comprehensive response that addresses this query using the context and analysis:\n\nQuery: {query}\nContext: {context}\nAnalysis: {analysis}"
-    )
-    print(f"Generated draft: {draft}")
-    
-    # Format markdown response
-    response = {
+""",
         "writer": f"""<details open>
 <summary>### ✍️ Initial Draft</summary>
 
@@ -183,57 +287,34 @@ def writer_agent(state: AgentState) -> AgentState:
     
     # Update state while preserving existing fields
     state["current_step"] = "critic"
+    state["analysis"] = analysis
     state["draft"] = draft
+    state["agent_outputs"]["research"] = response["research"]
     state["agent_outputs"]["writer"] = response["writer"]
     
-    print(f"Output state: {state}")
     return state
 
-def critic_agent(state: AgentState) -> AgentState:
+async def critic_agent(state: AgentState) -> AgentState:
     """Critic agent that refines and finalizes the response."""
-    print("\n=== Critic Agent ===")
-    print(f"Input state: {state}")
+    query = state["query"]
+    draft = state["draft"]
     
-    query = state.get("query")
-    if not query:
-        query = state["messages"][-1].content
-        state["query"] = query
-    
-    draft = state.get("draft", "")
-    context = state.get("context", "")
-    analysis = state.get("analysis", "")
-    
-    # Review and refine
-    feedback = llm.invoke(
-        f"""Review this draft response and provide specific feedback:
-        Query: {query}
-        Context: {context}
-        Analysis: {analysis}
-        Draft: {draft}
-        
-        Provide feedback on:
-        1. Accuracy and factual correctness
-        2. Completeness of response
-        3. Clarity and structure
-        4. Areas for improvement
-        """
-    )
-    print(f"Generated feedback: {feedback}")
+    # Review and refine (the final pass depends on the feedback, so these
+    # two calls stay sequential)
+    feedback = await feedback_chain.ainvoke({
+        "query": query,
+        "context": state["context"],
+        "analysis": state["analysis"],
+        "draft": draft
+    })
+    logger.debug("critic feedback_len=%d", len(feedback))
     
-    final = llm.invoke(
-        f"""Create a final polished response incorporating this feedback:
-        Original Query: {query}
-        Draft: {draft}
-        Feedback: {feedback}
-        
-        Requirements:
-        1. Address all feedback points
-        2. Maintain clear structure
-        3. Ensure completeness
-        4. Polish language and flow
-        """
-    )
-    print(f"Generated final response: {final}")
+    final = await final_chain.ainvoke({
+        "query": query,
+        "draft": draft,
+        "feedback": feedback
+    })
+    logger.debug("critic final_len=%d", len(final))
     
     # Format final markdown response with detailed sections
     response = {
@@ -278,7 +359,7 @@ def critic_agent(state: AgentState) -> AgentState:
     state["agent_outputs"]["critic"] = response["critic"]
     state["agent_outputs"]["response"] = response["response"]
     
-    print(f"Final state: {state}")
+    logger.debug("critic done current_step=%s", state["current_step"])
     return state
 
 # Create the graph
@@ -286,14 +367,12 @@ workflow = StateGraph(AgentState)
 
 # Add nodes for each agent
 workflow.add_node("retriever", retriever_agent)
-workflow.add_node("researcher", researcher_agent)
-workflow.add_node("writer", writer_agent)
+workflow.add_node("analyze_and_draft", analyze_and_draft_agent)
 workflow.add_node("critic", critic_agent)
 
 # Add edges to connect the workflow
-workflow.add_edge("retriever", "researcher")
-workflow.add_edge("researcher", "writer")
-workflow.add_edge("writer", "critic")
+workflow.add_edge("retriever", "analyze_and_draft")
+workflow.add_edge("analyze_and_draft", "critic")
 
 # Set the entry point
 workflow.set_entry_point("retriever")
@@ -305,14 +384,14 @@ if __name__ == "__main__":
     # Test the workflow
     print("\n=== Testing Agent Workflow ===")
     test_query = "What is the latest document in store?"
-    result = chain.invoke({
+    result = asyncio.run(chain.ainvoke({
         "messages": [HumanMessage(content=test_query)],
         "current_step": "retriever",
         "context": "",
         "research_summary": "",
         "final_answer": "",
         "agent_outputs": {}
-    })
+    }))
     
     print("\n=== Final Result ===")
     print(json.dumps(result["agent_outputs"], indent=2))
@@ -1,32 +1,104 @@
 from typing import Dict, List, Optional
+import hashlib
+import itertools
+import multiprocessing
 import os
+import pickle
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
-from langchain_community.document_loaders import (
-    PyPDFLoader,
-    TextLoader,
-    UnstructuredMarkdownLoader,
-    DirectoryLoader
-)
 from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_core.documents import Document
+from langchain_ollama import OllamaEmbeddings
 from datetime import datetime
 
-from main import vectorstore
+from loaders import SUPPORTED_EXTENSIONS, load_document
+
+# Parsed and split documents, keyed by file content hash
+SPLITS_CACHE_DIR = Path(".cache")
 
 class Processor:
     """A processor that ingests various types of documents into a vector store for later retrieval."""
     
-    SUPPORTED_EXTENSIONS = {
-        '.pdf': PyPDFLoader,
-        '.txt': TextLoader,
-        '.md': UnstructuredMarkdownLoader
-    }
+    SUPPORTED_EXTENSIONS = SUPPORTED_EXTENSIONS
+    
+    # Number of chunks sent to Ollama per embedding request
+    EMBED_BATCH_SIZE = 32
+    # Number of embedding requests in flight per document
+    EMBED_CONCURRENCY = 4
+    
+    # Text splitter settings; "" is only used for text without any other separator
+    CHUNK_SIZE = 1000
+    CHUNK_OVERLAP = 100
+    SEPARATORS = ["\n\n", "\n", ". ", " ", ""]
     
     def __init__(self):
+        # Imported here rather than at module level: spawned parse workers re-run
+        # this module when it is the CLI entry point, and must not build their
+        # own Chroma and Ollama clients
+        from main import vectorstore, OLLAMA_BASE_URL, MODEL_NAME
+        self.vectorstore = vectorstore
+        
         self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200
+            chunk_size=self.CHUNK_SIZE,
+            chunk_overlap=self.CHUNK_OVERLAP,
+            separators=self.SEPARATORS,
+            length_function=len,
+            is_separator_regex=False
+        )
+        # Cached splits are only valid for the splitter settings that made them
+        self._splitter_key = hashlib.sha256(
+            repr((self.CHUNK_SIZE, self.CHUNK_OVERLAP, self.SEPARATORS)).encode()
+        ).hexdigest()[:12]
+        
+        # Document parsing is CPU-bound, so it runs in separate processes.
+        # Spawn avoids forking while ingest and Chroma threads are running.
+        self._process_pool = ProcessPoolExecutor(
+            max_workers=os.cpu_count(),
+            mp_context=multiprocessing.get_context("spawn")
         )
         
+        # One embedding client per Ollama node (comma-separated in
+        # OLLAMA_EMBEDDING_URLS), shared by all worker threads
+        embedding_urls = [
+            url.strip()
+            for url in os.getenv("OLLAMA_EMBEDDING_URLS", OLLAMA_BASE_URL).split(",")
+            if url.strip()
+        ]
+        self.embedding_clients = [
+            OllamaEmbeddings(base_url=url, model=MODEL_NAME)
+            for url in embedding_urls
+        ]
+        self._client_cycle = itertools.cycle(self.embedding_clients)
+        self._client_lock = threading.Lock()
+        
+        # Content hashes of documents currently being processed
+        self._in_flight_hashes = set()
+        self._hash_lock = threading.Lock()
+        
+    def close(self) -> None:
+        """Shut down the document parsing worker processes."""
+        self._process_pool.shutdown()
+        
+    def _next_embedding_client(self) -> OllamaEmbeddings:
+        """Return the next embedding client in round-robin order."""
+        with self._client_lock:
+            return next(self._client_cycle)
+        
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        return self._next_embedding_client().embed_documents(texts)
+        
+    def _embed_texts(self, texts: List[str]) -> List[List[float]]:
+        """Embed texts in batches, sending the batches to Ollama concurrently."""
+        batches = [
+            texts[i:i + self.EMBED_BATCH_SIZE]
+            for i in range(0, len(texts), self.EMBED_BATCH_SIZE)
+        ]
+        with ThreadPoolExecutor(max_workers=self.EMBED_CONCURRENCY) as executor:
+            results = executor.map(self._embed_batch, batches)
+        return [vector for batch in results for vector in batch]
+    
     def process_document(self, file_path: str, document_type: Optional[str] = None) -> bool:
         """Process a single document file into the vector store."""
         try:
@@ -39,35 +111,93 @@ class Processor:
             if ext not in self.SUPPORTED_EXTENSIONS:
                 raise ValueError(f"Unsupported file type: {ext}. Supported types: {list(self.SUPPORTED_EXTENSIONS.keys())}")
             
-            print(f"Processing {path.name}...")
+            content_hash = hashlib.sha256(path.read_bytes()).hexdigest()
             
-            loader_class = self.SUPPORTED_EXTENSIONS[ext]
-            loader = loader_class(str(path))
+            # Claim the hash so identical files processed concurrently are
+            # indexed only once
+            with self._hash_lock:
+                if content_hash in self._in_flight_hashes:
+                    print(f"Skipping {path.name}, same content is already being processed")
+                    return True
+                self._in_flight_hashes.add(content_hash)
             
-            # Load and process document
-            documents = loader.load()
-            
-            # Add metadata
-            for doc in documents:
-                doc.metadata.update({
+            try:
+                # Skip files whose exact content is already indexed
+                if self.vectorstore._collection.get(where={'content_hash': content_hash}, limit=1, include=[])['ids']:
+                    print(f"Skipping {path.name}, already indexed")
+                    return True
+                
+                print(f"Processing {path.name}...")
+                
+                # Reuse the parsed chunks if this content was split before
+                cache_path = SPLITS_CACHE_DIR / f"{content_hash}.{self._splitter_key}.pkl"
+                if cache_path.exists():
+                    with open(cache_path, 'rb') as f:
+                        splits = pickle.load(f)
+                else:
+                    # Load and split document into chunks
+                    pages = self._process_pool.submit(load_document, str(path), ext).result()
+                    documents = [
+                        Document(page_content=page_content, metadata=metadata)
+                        for page_content, metadata in pages
+                    ]
+                    splits = self.text_splitter.split_documents(documents)
+                
+                    SPLITS_CACHE_DIR.mkdir(exist_ok=True)
+                    tmp_path = cache_path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+                    with open(tmp_path, 'wb') as f:
+                        pickle.dump(splits, f)
+                    os.replace(tmp_path, cache_path)
+                
+                # Add metadata, computed once for all chunks of the document
+                metadata_update = {
                     'source': str(path),
                     'filename': path.name,
                     'type': document_type or 'general',
                     'date_processed': datetime.now().isoformat(),
-                })
-            
-            # Split documents into chunks
-            splits = self.text_splitter.split_documents(documents)
-            
-            # Add to vector store
-            vectorstore.add_documents(splits)
-            print(f"Successfully processed {path.name} ({len(splits)} chunks created)")
-            return True
+                    'content_hash': content_hash,
+                }
+                for doc in splits:
+                    doc.metadata.update(metadata_update)
+                
+                # Embed all chunks up front, then add them without re-embedding
+                if splits:
+                    texts = [split.page_content for split in splits]
+                    self.vectorstore._collection.add(
+                        ids=[str(uuid.uuid4()) for _ in splits],
+                        embeddings=self._embed_texts(texts),
+                        documents=texts,
+                        metadatas=[split.metadata for split in splits]
+                    )
+                print(f"Successfully processed {path.name} ({len(splits)} chunks created)")
+                return True
+            finally:
+                with self._hash_lock:
+                    self._in_flight_hashes.discard(content_hash)
             
         except Exception as e:
             print(f"Error processing document {file_path}: {str(e)}")
             return False
 
+    def _iter_supported_files(self, root: str):
+        """Yield paths of supported files under root in a single directory walk."""
+        stack = [root]
+        while stack:
+            directory = stack.pop()
+            try:
+                entries = os.scandir(directory)
+            except OSError as e:
+                # Skip unreadable directories instead of aborting the whole walk
+                print(f"Skipping directory {directory}: {str(e)}")
+                continue
+            
+            with entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif os.path.splitext(entry.name)[1].lower() in self.SUPPORTED_EXTENSIONS:
+                        yield entry.path
+
     def process_directory(self, directory_path: str, document_type: Optional[str] = None) -> Dict[str, int]:
         """Process all supported documents in a directory."""
         stats = {
@@ -81,13 +211,19 @@ class Processor:
             if not path.exists() or not path.is_dir():
                 raise NotADirectoryError(f"Directory not found: {directory_path}")
             
-            # Process each supported file in the directory
-            for ext, _ in self.SUPPORTED_EXTENSIONS.items():
-                files = list(path.glob(f"**/*{ext}"))
-                stats['total'] += len(files)
-                
-                for file_path in files:
-                    if self.process_document(str(file_path), document_type):
+            # Collect each supported file in the directory
+            files = list(self._iter_supported_files(directory_path))
+            stats['total'] = len(files)
+            
+            # Process files in parallel, two per Ollama node
+            max_workers = 2 * len(self.embedding_clients)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [
+                    executor.submit(self.process_document, file_path, document_type)
+                    for file_path in files
+                ]
+                for future in as_completed(futures):
+                    if future.result():
                         stats['successful'] += 1
                     else:
                         stats['failed'] += 1
@@ -100,34 +236,37 @@ class Processor:
 def main():
     processor = Processor()
     
-    while True:
-        print("\n=== Knowledge Base ===")
-        print("1. Process single document")
-        print("2. Process directory")
-        print("3. Exit")
+    try:
+        while True:
+            print("\n=== Knowledge Base ===")
+            print("1. Process single document")
+            print("2. Process directory")
+            print("3. Exit")
         
-        choice = input("\nEnter your choice (1-3): ")
+            choice = input("\nEnter your choice (1-3): ")
         
-        if choice == "1":
-            file_path = input("Enter the path to your document: ")
-            doc_type = input("Enter document type (press Enter for 'general'): ")
-            if processor.process_document(file_path, doc_type or None):
-                print("Document processed successfully!")
+            if choice == "1":
+                file_path = input("Enter the path to your document: ")
+                doc_type = input("Enter document type (press Enter for 'general'): ")
+                if processor.process_document(file_path, doc_type or None):
+                    print("Document processed successfully!")
             
-        elif choice == "2":
-            dir_path = input("Enter the directory path: ")
-            doc_type = input("Enter document type (press Enter for 'general'): ")
-            stats = processor.process_directory(dir_path, doc_type or None)
-            print(f"\nProcessing complete:")
-            print(f"Total files: {stats['total']}")
-            print(f"Successfully processed: {stats['successful']}")
-            print(f"Failed: {stats['failed']}")
+            elif choice == "2":
+                dir_path = input("Enter the directory path: ")
+                doc_type = input("Enter document type (press Enter for 'general'): ")
+                stats = processor.process_directory(dir_path, doc_type or None)
+                print(f"\nProcessing complete:")
+                print(f"Total files: {stats['total']}")
+                print(f"Successfully processed: {stats['successful']}")
+                print(f"Failed: {stats['failed']}")
             
-        elif choice == "3":
-            break
+            elif choice == "3":
+                break
             
-        else:
-            print("Invalid choice. Please try again.")
+            else:
+                print("Invalid choice. Please try again.")
+    finally:
+        processor.close()
 
 if __name__ == "__main__":
     main()